@@ -21,17 +21,28 @@ Contact: arzwa@psb.vib-ugent.be
 
 --------------------------------------------------------------------------------
 """
+import os
+import sys
 import numpy as np
 import logging
 from sklearn import mixture
-import scipy.stats as ss
-import plumbum as pb
-import matplotlib
+from joblib import Parallel, delayed
+from scipy.signal import fftconvolve
 
-if not 'DISPLAY' in pb.local.env:
-    matplotlib.use('Agg')  # use this backend when no X server
-import matplotlib.pyplot as plt
-import seaborn as sns
+
+def _pyplot():
+    """
+    Import pyplot on first use, so that fitting models does not pull in
+    matplotlib. Selects the Agg backend when there is no X server.
+
+    :return: matplotlib.pyplot module
+    """
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        if not 'DISPLAY' in os.environ:
+            matplotlib.use('Agg')  # use this backend when no X server
+    import matplotlib.pyplot as plt
+    return plt
 
 
 def filter_group_data(
@@ -53,23 +64,21 @@ def filter_group_data(
     """
     # pre node-grouping filters, irrespective of outlier removal
     df = df.dropna()
-    df = df[df["AlignmentCoverage"] >= aln_cov]
-    df = df[df["AlignmentIdentity"] >= aln_id]
-    df = df[df["AlignmentLength"] >= aln_len]
+    df = df[(df["AlignmentCoverage"] >= aln_cov) &
+            (df["AlignmentIdentity"] >= aln_id) &
+            (df["AlignmentLength"] >= aln_len)]
 
     # Ks range filters
     # if one filters before the node-weighting, the weights are adapted with
     # respect to the outlier filtering (as in Vanneste et al. 2013)
     if not weights_outliers_included:
-        df = df[df["Ks"] > min_ks]
-        df = df[df["Ks"] <= max_ks]
+        df = df[(df["Ks"] > min_ks) & (df["Ks"] <= max_ks)]
 
     # grouping
     df = df.groupby(['Family', 'Node']).mean()
 
     if weights_outliers_included:
-        df = df[df["Ks"] > min_ks]
-        df = df[df["Ks"] <= max_ks]
+        df = df[(df["Ks"] > min_ks) & (df["Ks"] <= max_ks)]
 
     return df
 
@@ -81,9 +90,9 @@ def get_array_for_mixture(df):
     :param df: data frame
     :return: array
     """
-    X = np.array(df["Ks"].dropna())
-    X = X[X > 0]
-    X = np.log(X).reshape(-1, 1)
+    ks = df["Ks"].to_numpy()
+    # NaN compares False, so this single mask also drops missing values
+    X = np.log(ks[ks > 0]).reshape(-1, 1)
     return X
 
 
@@ -98,6 +107,60 @@ def reflect(data):
     return np.hstack([data, reflection])
 
 
+def binned_kde(data, bandwidth, n=1024, cut=3):
+    """
+    Univariate Gaussian KDE evaluated on a regular grid. The data is linearly
+    binned on the grid and the bin counts are convolved with the kernel using an
+    FFT, which costs O(n log n) in the grid size instead of the O(N * n) of
+    evaluating every kernel at every grid point.
+
+    :param data: np.array
+    :param bandwidth: kernel standard deviation (absolute, in data units)
+    :param n: number of grid points
+    :param cut: extend the grid this many bandwidths beyond the data range
+    :return: grid, density
+    """
+    if not (np.isfinite(bandwidth) and bandwidth > 0):
+        raise ValueError("Bandwidth should be positive and finite, got {} "
+                         "(constant or too few data points?)".format(bandwidth))
+    data = np.asarray(data).ravel()
+    x = np.linspace(data.min() - cut * bandwidth,
+                    data.max() + cut * bandwidth, n)
+    dx = x[1] - x[0]
+
+    # linear binning, each point's mass is split over the two nearest grid
+    # points
+    pos = (data - x[0]) / dx
+    i = np.clip(np.floor(pos).astype(int), 0, n - 2)
+    f = pos - i
+    counts = np.bincount(i, 1 - f, n) + np.bincount(i + 1, f, n)
+
+    half = min(int(np.ceil(4 * bandwidth / dx)), n - 1)
+    k = np.arange(-half, half + 1) * dx
+    kernel = np.exp(-0.5 * (k / bandwidth) ** 2) / (
+            bandwidth * np.sqrt(2 * np.pi))
+    pdf = fftconvolve(counts, kernel, mode='same') / len(data)
+    return x, np.clip(pdf, 0, None)  # clip round-off below zero
+
+
+def silverman_bandwidth(data):
+    """
+    Rule of thumb bandwidth for a univariate Gaussian KDE, robust against
+    heavy tails and multimodality by using the smaller of the standard deviation
+    and the scaled interquartile range (Silverman 1986)::
+
+        h = 1.06 * min(sd, IQR / 1.34) * n^(-1/5)
+
+    :param data: np.array
+    :return: bandwidth
+    """
+    data = np.asarray(data).ravel()
+    sd = np.std(data, ddof=1)
+    iqr = np.subtract(*np.percentile(data, [75, 25]))
+    spread = min(sd, iqr / 1.34) if iqr > 0 else sd
+    return 1.06 * spread * len(data) ** -0.2
+
+
 def reflected_kde(df, min_ks, max_ks, bandwidth, bins, out_file):
     """
     Perform Kernel density estimation (KDE) with reflected data.
@@ -106,35 +169,79 @@ def reflected_kde(df, min_ks, max_ks, bandwidth, bins, out_file):
     :param df: data frame
     :param min_ks: minimum Ks value (best is to use 0, for reflection purposes)
     :param max_ks: maximum Ks value
-    :param bandwidth: bandwidth (None results in Scott's rule of thumb)
+    :param bandwidth: bandwidth factor, multiplying the standard deviation of
+        the reflected data (as `bw_method` in `wgd viz`). None results in
+        Silverman's rule of thumb on the unreflected data, see
+        `silverman_bandwidth`
     :param bins: number of histogram bins
     :param out_file: output file
     :return: nada
     """
+    plt = _pyplot()
+    import seaborn as sns
     ks = np.array(df['Ks'])
     ks_reflected = reflect(ks)
-    fig, ax = plt.subplots(figsize=(9, 4))
     if bandwidth:
-        ax = sns.distplot(
-                ks_reflected, bins=bins * 2, ax=ax,
-                hist_kws={"rwidth": 0.8, "color": "k", "alpha": 0.2},
-                kde_kws={"bw": bandwidth},
-                color="k"
-        )
+        # a factor, as for scipy's (and wgd viz') gaussian_kde
+        bandwidth = bandwidth * np.std(ks_reflected, ddof=1)
     else:
-        ax = sns.distplot(
-                ks_reflected, bins=bins * 2, ax=ax,
-                hist_kws={"rwidth": 0.8, "color": "k", "alpha": 0.2},
-                color="k"
-        )
+        # computed on the original data, reflection inflates the spread
+        bandwidth = silverman_bandwidth(ks)
+        logging.info("Using bandwidth {:.4f} (Silverman's rule)".format(
+                bandwidth))
+    fig, ax = plt.subplots(figsize=(9, 4), constrained_layout=True)
+    ax.hist(ks_reflected, bins=bins * 2, rwidth=0.8, color="k", alpha=0.2,
+            density=True)
+    x, pdf = binned_kde(ks_reflected, bandwidth)
+    ax.plot(x, pdf, color="k")
     ax.set_xlim(min_ks, max_ks)
     sns.despine(offset=5, trim=False)
     ax.set_ylabel("Density")
     ax.set_xlabel("$K_{\mathrm{S}}$")
-    fig.savefig(out_file, bbox_inches='tight')
+    fig.savefig(out_file)
+    plt.close(fig)
+
 
+def _subsample(X, max_samples, seed=0):
+    """
+    Take a random subsample (without replacement) of at most ``max_samples``
+    rows of an array. EM cost is linear in the number of data points, while
+    for a 1-D mixture with a handful of components some 10,000s of points
+    already determine the fit.
+
+    :param X: data array (n x 1)
+    :param max_samples: maximum number of rows, None for no subsampling
+    :param seed: random seed, for a reproducible subsample
+    :return: array
+    """
+    if max_samples is None or len(X) <= max_samples:
+        return X
+    logging.info("Fitting on a random subsample of {} out of {} data "
+                 "points".format(max_samples, len(X)))
+    idx = np.random.RandomState(seed).choice(len(X), max_samples,
+                                             replace=False)
+    return X[idx]
+
+
+def _split_widest_component(model):
+    """
+    Initial means for a mixture with one component more than ``model``: the
+    fitted means, with the widest component split in two halfway its standard
+    deviation on either side of its mean.
 
-def fit_gmm(X, n1, n2, max_iter=100, n_init=1, **kwargs):
+    :param model: fitted mixture model object
+    :return: array (n_components + 1 x n_features)
+    """
+    cov = model.covariances_
+    k = np.argmax(np.trace(cov, axis1=1, axis2=2))
+    shift = np.sqrt(np.diag(cov[k])) / 2
+    means = model.means_.copy()
+    means[k] -= shift
+    return np.vstack([means, model.means_[k] + shift])
+
+
+def fit_gmm(X, n1, n2, max_iter=100, n_init=1, n_threads=1,
+            max_fit_samples=20000, ic_tol=None, seed_means=False, **kwargs):
     """
     Compute Gaussian mixtures for different numbers of components
 
@@ -143,24 +250,52 @@ def fit_gmm(X, n1, n2, max_iter=100, n_init=1, **kwargs):
     :param n2: maximum number of components
     :param max_iter: maximum number of iterations
     :param n_init: number of k-means initializations
+    :param n_threads: number of models to fit in parallel
+    :param max_fit_samples: fit on a random subsample of at most this many
+        data points (None to use all data), the AIC and BIC are computed on
+        the full data
+    :param ic_tol: if not None, fit the models sequentially and stop as soon
+        as the BIC increased by more than ``ic_tol`` for two consecutive
+        numbers of components (only the models fitted so far are returned)
+    :param seed_means: if True, fit the models sequentially and initialize the
+        means of each model from the previous one, splitting its widest
+        component (ignored when ``means_init`` is given in ``kwargs``)
     :param kwargs: other keyword args for `GaussianMixture`
     :return: models, bic, aic, best model
     """
-    # fit models with 1 to n components
+    # fit models with 1 to n components, these are independent EM runs
     N = np.arange(n1, n2 + 1)
-    models = [None for i in range(len(N))]
-    for i in range(len(N)):
-        logging.info("Fitting GMM with {} components".format(N[i]))
-        models[i] = mixture.GaussianMixture(
-                n_components=N[i], covariance_type='full', max_iter=max_iter,
-                n_init=n_init, **kwargs
-        ).fit(X)
-        logging.info("Component mean, variance, weight: ")
-        log_components(models[i])
-
-    # compute the AIC and the BIC
+    X_fit = _subsample(X, max_fit_samples)
+    gmms = [mixture.GaussianMixture(
+            n_components=n, covariance_type='full', max_iter=max_iter,
+            n_init=n_init, **kwargs) for n in N]
+    logging.info("Fitting GMMs with {} to {} components".format(n1, n2))
+    seed_means = seed_means and 'means_init' not in kwargs
+    if ic_tol is None and not seed_means:
+        models = Parallel(n_jobs=n_threads)(
+                delayed(m.fit)(X_fit) for m in gmms)
+        bic = [m.bic(X) for m in models]
+    else:
+        models, bic = [], []
+        for m in gmms:
+            if seed_means and models:
+                m.set_params(means_init=_split_widest_component(models[-1]))
+            models.append(m.fit(X_fit))
+            bic.append(m.bic(X))
+            if ic_tol is not None and len(bic) > 2 \
+                    and bic[-1] - bic[-2] > ic_tol \
+                    and bic[-2] - bic[-3] > ic_tol:
+                logging.info("BIC increased for two consecutive models, not "
+                             "fitting more than {} components".format(
+                        m.n_components))
+                break
+    for model in models:
+        logging.info("GMM with {} components, component mean, variance, "
+                     "weight: ".format(model.n_components))
+        log_components(model)
+
+    # compute the AIC
     aic = [m.aic(X) for m in models]
-    bic = [m.bic(X) for m in models]
     best = models[np.argmin(bic)]
 
     return models, bic, aic, best
@@ -174,7 +309,8 @@ def log_components(m):
         )
 
 
-def fit_bgmm(X, n1, n2, gamma=1e-3, max_iter=100, n_init=1, **kwargs):
+def fit_bgmm(X, n1, n2, gamma=1e-3, max_iter=100, n_init=1, n_threads=1,
+             max_fit_samples=20000, **kwargs):
     """
     Compute Bayesian Gaussian mixture
 
@@ -184,27 +320,63 @@ def fit_bgmm(X, n1, n2, gamma=1e-3, max_iter=100, n_init=1, **kwargs):
     :param gamma: inverse of regularization strength
     :param max_iter: maximum number of iterations
     :param n_init: number of k-means initializations
+    :param n_threads: number of models to fit in parallel
+    :param max_fit_samples: fit on a random subsample of at most this many
+        data points (None to use all data)
     :param kwargs: other keyword args for `GaussianMixture`
     :return: models
     """
-    # fit models with 1 to n components
+    # fit models with 1 to n components, these are independent VB runs
     N = np.arange(n1, n2 + 1)
-    models = [None for i in range(len(N))]
-
-    for i in range(len(N)):
-        logging.info("Fitting BGMM with {} components".format(N[i]))
-        models[i] = mixture.BayesianGaussianMixture(
-                weight_concentration_prior=gamma, n_init=n_init,
-                n_components=N[i], covariance_type='full', max_iter=max_iter,
-                **kwargs
-        ).fit(X)
-        log_components(models[i])
+    X_fit = _subsample(X, max_fit_samples)
+    logging.info("Fitting BGMMs with {} to {} components".format(n1, n2))
+    models = Parallel(n_jobs=n_threads)(
+            delayed(mixture.BayesianGaussianMixture(
+                    weight_concentration_prior=gamma, n_init=n_init,
+                    n_components=n, covariance_type='full', max_iter=max_iter,
+                    **kwargs
+            ).fit)(X_fit) for n in N)
+    for n, model in zip(N, models):
+        logging.info("BGMM with {} components:".format(n))
+        log_components(model)
 
     return models
 
 
+def mixture_histogram(data, l=0, u=5, log=False, bins=25):
+    """
+    Density histogram of log-transformed Ks data, back-transformed unless
+    ``log`` is set, within the range [l, u].
+
+    :param data: data array
+    :param l: lower Ks limit
+    :param u: upper Ks limit
+    :param log: keep the data on log scale?
+    :param bins: number of histogram bins
+    :return: densities and bin edges (as `np.histogram`)
+    """
+    if not log:
+        data = np.exp(data)
+    return np.histogram(data[(data >= l) & (data <= u)], bins, density=True)
+
+
+def _weighted_normal_pdf(x, mu, sd, w):
+    """
+    Weighted normal densities, broadcasting grid points (rows) against
+    components (columns).
+
+    :param x: grid (n x 1)
+    :param mu: component means (1 x k)
+    :param sd: component standard deviations (1 x k)
+    :param w: component weights (k)
+    :return: array (n x k)
+    """
+    z = (x - mu) / sd
+    return w / (sd * np.sqrt(2 * np.pi)) * np.exp(-0.5 * z * z)
+
+
 def plot_mixture(model, data, ax, l=0, u=5, color='black', alpha=0.2,
-                 log=False, bins=25, alpha_l1=1):
+                 log=False, bins=25, alpha_l1=1, hist=None):
     """
     Plot a mixture model. Assumes a log-transformed model and data
     and will back-transform.
@@ -231,35 +403,31 @@ def plot_mixture(model, data, ax, l=0, u=5, color='black', alpha=0.2,
     :param log: plot on log scale?
     :param bins: number of histogram bins
     :param alpha_l1: alpha value for mixture lines
+    :param hist: precomputed histogram from `mixture_histogram`, when plotting
+        several models for the same data (``data`` is ignored in that case)
     :return: ax
     """
-    x = np.linspace(l, u, 1000).reshape((-1, 1))
+    # plot-only grid, single precision is plenty
+    x = np.linspace(l, u, 1000, dtype=np.float32).reshape((-1, 1))
+    if hist is None:
+        hist = mixture_histogram(data, l, u, log, bins)
+    density, edges = hist
+    ax.hist(edges[:-1], edges, weights=density, rwidth=0.8, color=color,
+            alpha=alpha)
+    # evaluate all components at once, one column per component
+    means = model.means_.reshape((1, -1)).astype(x.dtype)
+    sds = np.sqrt(model.covariances_).reshape((1, -1)).astype(x.dtype)
+    weights = model.weights_.astype(x.dtype)
     if not log:
-        data = np.exp(data)
-    data = data[data >= l]
-    data = data[data <= u]
-    bins = ax.hist(
-            data, bins, rwidth=0.8, color=color, alpha=alpha, density=True)
-    maxy = max(bins[0])
-    means = model.means_
-    varcs = model.covariances_
-    weights = model.weights_
-    mix = None
-    first = True
-    for k in range(len(means)):
-        if not log:
-            curve = ss.lognorm.pdf(
-                    x, scale=np.exp(means[k]), s=np.sqrt(varcs[k])) * weights[k]
-        else:
-            curve = ss.norm.pdf(
-                    x, loc=means[k], scale=np.sqrt(varcs[k])) * weights[k]
-        ax.plot(x, curve, '--k', color='black', alpha=0.4)
-        if first:
-            mix = curve
-            first = False
-        else:
-            mix += curve
-    ax.plot(x, mix, color='black', alpha=alpha_l1)
+        # lognormal density: the normal density of log(x), divided by x
+        pos = x > 0
+        logx = np.log(x, out=np.full_like(x, -np.inf), where=pos)
+        curves = _weighted_normal_pdf(logx, means, sds, weights)
+        curves = np.divide(curves, x, out=np.zeros_like(curves), where=pos)
+    else:
+        curves = _weighted_normal_pdf(x, means, sds, weights)
+    ax.plot(x, curves, '--k', color='black', alpha=0.4)
+    ax.plot(x, curves.sum(axis=1), color='black', alpha=alpha_l1)
     ax.set_xlim(l, u)
     if log:
         ax.set_xlabel("$\mathrm{log}(K_{\mathrm{S}})$")
@@ -330,11 +498,11 @@ def plot_probs(m, ax, l=0.0, u=5, ylab=True):
     """
     if l == 0:
         l = 0.005
-    x = np.linspace(l, u, 1000).reshape(-1, 1)
+    x = np.linspace(l, u, 1000, dtype=np.float32).reshape(-1, 1)
     p = m.predict_proba(np.log(x))
     p = p.cumsum(1).T
-    x = np.linspace(l, u, 1000)
-    order = tuple(np.argsort(m.means_.reshape((1, -1)))[0])
+    x = x.ravel()
+    order = tuple(np.argsort(m.means_.ravel()))
     alphas = np.linspace(0.2, 1, p.shape[0])[order,]
     for i, array in enumerate(p):
         if i == 0:
@@ -365,11 +533,15 @@ def plot_aic_bic(aic, bic, min_n, max_n, out_file):
 
     :param aic: aic values
     :param bic: bic values
+    :param min_n: minimum number of components
+    :param max_n: maximum number of components
     :param out_file: output file
     :return: nada
     """
-    x_range = list(range(min_n, max_n + 1))
-    fig, axes = plt.subplots(1, 2, figsize=(12, 3))
+    plt = _pyplot()
+    # the model range may have been cut short (see `fit_gmm`)
+    x_range = list(range(min_n, max_n + 1))[:len(aic)]
+    fig, axes = plt.subplots(1, 2, figsize=(12, 3), constrained_layout=True)
     axes[0].plot(np.arange(1, len(aic) + 1), aic, color='k', marker='o')
     axes[0].set_xticks(list(range(1, len(aic) + 1)))
     axes[0].set_xticklabels(x_range)
@@ -382,8 +554,8 @@ def plot_aic_bic(aic, bic, min_n, max_n, out_file):
     axes[1].grid(ls=":")
     axes[1].set_ylabel("BIC")
     axes[1].set_xlabel("# components")
-    fig.tight_layout()
     fig.savefig(out_file)
+    plt.close(fig)
 
 
 def plot_bars_weights(model, ax):
@@ -394,13 +566,12 @@ def plot_bars_weights(model, ax):
     :param ax: figure ax
     :return: ax
     """
-    ax.bar(np.arange(1, model.n_components + 1), model.weights_, color='k',
-           alpha=0.2)
-    for i, mn in enumerate(model.means_):
+    x = np.arange(1, model.n_components + 1)
+    ax.bar(x, model.weights_, color='k', alpha=0.2)
+    for xi, w, mn in zip(x, model.weights_, np.exp(model.means_[:, 0])):
         ax.text(
-                x=i + 1, y=model.weights_[i] + 0.1,
-                horizontalalignment='center',
-                s='$\hat{{\mu}} = {:.2f}$'.format(np.exp(mn)[0])
+                x=xi, y=w + 0.1, horizontalalignment='center',
+                s='$\hat{{\mu}} = {:.2f}$'.format(mn)
         )
     ax.set_ylabel("weight")
     ax.set_xlabel("component")
@@ -420,15 +591,21 @@ def plot_all_models_gmm(models, data, l, u, bins, out_file):
     :param out_file: output file
     :return: nada
     """
-    fig, axes = plt.subplots(len(models), 3, figsize=(15, 3 * len(models)))
+    plt = _pyplot()
+    import seaborn as sns
+    fig, axes = plt.subplots(len(models), 3, figsize=(15, 3 * len(models)),
+                             constrained_layout=True)
+    hist = mixture_histogram(data, l, u, bins=bins)
+    log_l, log_u = np.log(l + 0.0001), np.log(u)
+    hist_log = mixture_histogram(data, log_l, log_u, log=True, bins=bins)
     for i, model in enumerate(models):
-        plot_mixture(model, data, axes[i, 0], l, u, bins=bins)
-        plot_mixture(model, data, axes[i, 1], log=True, l=np.log(l + 0.0001),
-                     u=np.log(u), bins=bins)
+        plot_mixture(model, data, axes[i, 0], l, u, hist=hist)
+        plot_mixture(model, data, axes[i, 1], log=True, l=log_l, u=log_u,
+                     hist=hist_log)
         plot_probs(model, axes[i, 2], l, u)
     sns.despine(offset=5)
-    fig.tight_layout()
     fig.savefig(out_file)
+    plt.close(fig)
 
 
 def plot_all_models_bgmm(models, data, l, u, bins, out_file):
@@ -443,16 +620,22 @@ def plot_all_models_bgmm(models, data, l, u, bins, out_file):
     :param out_file: output file
     :return: nada
     """
-    fig, axes = plt.subplots(len(models), 4, figsize=(20, 3 * len(models)))
+    plt = _pyplot()
+    import seaborn as sns
+    fig, axes = plt.subplots(len(models), 4, figsize=(20, 3 * len(models)),
+                             constrained_layout=True)
+    hist = mixture_histogram(data, l, u, bins=bins)
+    log_l, log_u = np.log(l + 0.0001), np.log(u)
+    hist_log = mixture_histogram(data, log_l, log_u, log=True, bins=bins)
     for i, model in enumerate(models):
-        plot_mixture(model, data, axes[i, 0], l, u, bins=bins)
-        plot_mixture(model, data, axes[i, 1], log=True, l=np.log(l + 0.0001),
-                     u=np.log(u), bins=bins)
+        plot_mixture(model, data, axes[i, 0], l, u, hist=hist)
+        plot_mixture(model, data, axes[i, 1], log=True, l=log_l, u=log_u,
+                     hist=hist_log)
         plot_probs(model, axes[i, 2], l, u)
         plot_bars_weights(model, axes[i, 3])
     sns.despine(offset=5)
-    fig.tight_layout()
     fig.savefig(out_file)
+    plt.close(fig)
 
 
 def get_component_probabilities(df, model):
@@ -470,7 +653,7 @@ def get_component_probabilities(df, model):
     df = df.dropna()
 
     p = model.predict_proba(np.array(df['log(Ks)']).reshape(-1, 1))
-    order = np.argsort([x[0] for x in model.means_])
+    order = np.argsort(model.means_.ravel())
     order_dict = {i: order[i] for i in range(len(order))}
     for c in range(len(order)):
         col = 'p_component{}'.format(order_dict[c] + 1)
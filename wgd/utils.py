@@ -711,11 +711,16 @@ class gaussian_kde(object):
                 raise ValueError(msg)
 
         # compute the normalised residuals
-        chi2 = cdist(points.T, self.dataset.T, 'mahalanobis',
-                     VI=self.inv_cov) ** 2
-        # compute the pdf
-        result = np.sum(np.exp(-.5 * chi2) * self.weights,
-                        axis=1) / self._norm_factor
+        if self.d == 1:
+            # univariate (the usual Ks case), plain broadcasting is much
+            # cheaper than the generic Mahalanobis distance
+            chi2 = (points[0][:, None] - self.dataset[0][None, :]) ** 2 * \
+                   self.inv_cov[0, 0]
+        else:
+            chi2 = cdist(points.T, self.dataset.T, 'mahalanobis',
+                         VI=self.inv_cov) ** 2
+        # compute the pdf, the weighted sum over data points as a dot product
+        result = np.exp(-.5 * chi2).dot(self.weights) / self._norm_factor
 
         return result
 
@@ -979,7 +979,9 @@ def syn_(
 )
 @click.option(
         '--bandwidth', '-bw', default=None, show_default=True, type=float,
-        help="Bandwidth for Gaussian KDE, by default Scott's rule is used"
+        help="Bandwidth factor for the Gaussian KDE, multiplying the standard "
+             "deviation of the reflected data (as in `wgd viz`), by default "
+             "Silverman's rule is used"
 )
 @click.option(
         '--bins', '-b', default=25, show_default=True, type=int,
@@ -996,8 +998,11 @@ def kde(
     Fit a KDE to a Ks distribution.
 
     This accounts for boundary effects by applying reflection around the minimum
-    Ks value, removing spurious peaks in low Ks regions. Please modify the
-    bandwidth parameter if the KDE seems to be under- or overfitting.
+    Ks value, removing spurious peaks in low Ks regions. By default the
+    bandwidth is chosen with Silverman's rule of thumb on the (unreflected) Ks
+    values. Please set the bandwidth parameter if the KDE seems to be under- or
+    overfitting; it is a factor multiplying the standard deviation of the
+    reflected Ks values, as the bandwidth in `wgd viz`.
 
     Note that `wgd viz` allows interactive plotting of KDEs also and might be
     more convenient for exploratory analysis.
@@ -1076,9 +1081,29 @@ def kde_(ks_distribution, filters, ks_range, bandwidth, bins, output_file):
         '--max_iter', '-mi', default=1000, show_default=True,
         help='maximum number of iterations'
 )
+@click.option(
+        '--n_threads', '-nt', default=4, show_default=True,
+        help='number of models to fit in parallel'
+)
+@click.option(
+        '--ic_tol', '-tol', default=None, type=float, show_default=True,
+        help='stop fitting GMMs with more components once the BIC increased '
+             'by more than this value for two consecutive models'
+)
+@click.option(
+        '--max_fit_samples', '-ms', default=20000, show_default=True,
+        help='fit models on a random subsample of at most this many Ks '
+             'values, 0 to fit on all data'
+)
+@click.option(
+        '--seed_means', is_flag=True,
+        help='initialize each GMM from the fit with one component less, '
+             'splitting its widest component'
+)
 def mix(
         ks_distribution, filters, ks_range, bins, output_dir, method,
-        components, gamma, n_init, max_iter
+        components, gamma, n_init, max_iter, n_threads, ic_tol,
+        max_fit_samples, seed_means
 ):
     """
     Mixture modeling of Ks distributions.
@@ -1102,13 +1127,15 @@ def mix(
     """
     mix_(
             ks_distribution, filters, ks_range, method, components, bins,
-            output_dir, gamma, n_init, max_iter
+            output_dir, gamma, n_init, max_iter, n_threads, ic_tol,
+            seed_means, max_fit_samples
     )
 
 
 def mix_(
         ks_distribution, filters, ks_range, method, components, bins,
-        output_dir, gamma, n_init, max_iter
+        output_dir, gamma, n_init, max_iter, n_threads=4, ic_tol=None,
+        seed_means=False, max_fit_samples=20000
 ):
     """
     Mixture modeling tools.
@@ -1128,6 +1155,12 @@ def mix_(
     :param gamma: gamma parameter for BGMM
     :param n_init: number of k-means initializations (best is kept)
     :param max_iter: number of iterations
+    :param n_threads: number of models to fit in parallel
+    :param ic_tol: BIC tolerance for early stopping of GMM fits (None for no
+        early stopping)
+    :param seed_means: initialize GMM means from the previously fitted model
+    :param max_fit_samples: maximum number of Ks values to fit models on
+        (random subsample), 0 or None to fit on all data
     :return: nada
     """
     from wgd.modeling import filter_group_data, get_array_for_mixture, fit_gmm
@@ -1149,13 +1182,15 @@ def mix_(
 
     logging.info(" .. max_iter = {}".format(max_iter))
     logging.info(" .. n_init   = {}".format(n_init))
+    max_fit_samples = max_fit_samples or None
 
     # GMM method
     if method == "gmm":
         logging.info("Method is GMM, interpret best model with caution!")
         models, bic, aic, best = fit_gmm(
                 X, components[0], components[1], max_iter=max_iter,
-                n_init=n_init
+                n_init=n_init, n_threads=n_threads, ic_tol=ic_tol,
+                seed_means=seed_means, max_fit_samples=max_fit_samples
         )
         inspect_aic(aic)
         inspect_bic(bic)
@@ -1172,7 +1207,8 @@ def mix_(
         logging.info(" .. gamma    = {}".format(gamma))
         models = fit_bgmm(
                 X, components[0], components[1], gamma=gamma,
-                max_iter=max_iter, n_init=n_init
+                max_iter=max_iter, n_init=n_init, n_threads=n_threads,
+                max_fit_samples=max_fit_samples
         )
         logging.info("Plotting mixtures")
         plot_all_models_bgmm(models, X, ks_range[0], ks_range[1], bins=bins,